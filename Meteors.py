@@ -4,17 +4,20 @@ import ephem
 from datetime import datetime, timedelta
 import streamlit as st
 import matplotlib.pyplot as plt
-from SkyBrightnessAndLightPollution import astronomical_twilight, moon_sky_brightness, light_pollution
+from SkyBrightnessAndLightPollution import moon_sky_brightness, light_pollution, sky_limiting_magnitude, \
+    ASTRONOMICAL_TWILIGHT_ALT
 import matplotlib.colors
 
 class Meteors():
     """Holds the ephemeral data for all meteor sources. Holds an observer object."""
 
-    def __init__(self, observer, UTC_offset):
-        """Initializes the observer and sets up the meteor shower data."""
+    def __init__(self, observer, UTC_offset, use_extinction=False):
+        """Initializes the observer and sets up the meteor shower data. If use_extinction is True, the Moon's
+        skyglow is dimmed by the atmosphere above the observer's elevation."""
 
         self.observer = observer
         self.UTC_offset = UTC_offset
+        self.use_extinction = use_extinction
         self.shower_csv = pd.read_csv('ShowerData.csv')
         self.shower_csv.index = np.array(self.shower_csv["Code"], dtype=str)
         self._initialize_meteors()
@@ -74,25 +77,12 @@ class Meteors():
             showers_periods.append(gaussian)
         self.shower_csv["Gaussian"] = showers_periods
 
-    def _meteor_number_info(self, limiting_mag, active_shower_codes):
+    def _meteor_number_info(self, bortle_class, active_shower_codes):
         """Provides info to an observer on light pollution, moon phase, and active meteor showers."""
 
         # bortle class
-        if limiting_mag >= 7.6:
-            bortle_class = 1
-        elif limiting_mag >= 7.1:
-            bortle_class = 2
-        elif limiting_mag >= 6.6:
-            bortle_class = 3
-        elif limiting_mag >= 6.3:
-            bortle_class = 4
-        elif limiting_mag >= 5.6:
-            bortle_class = 5
-        elif limiting_mag >= 5.1:
-            bortle_class = 6
-        elif limiting_mag >= 4.6:
-            bortle_class = 7
-        elif limiting_mag <= 4:
+        bortle_class = int(bortle_class)
+        if bortle_class == 8:
             bortle_class = "8 or 9"
 
         # active showers
@@ -124,55 +114,26 @@ class Meteors():
 
         return active_showers, bortle_class, moon_message
     
-    def _sqm_to_bortle_to_limiting_mag(self, sqm):
-        """Converts mags per square arcsecond into Bortle class, and returns the corresponding limiting magnitude."""
-
-        if sqm >= 21.75:
-            return 7.6
-        elif sqm >= 21.6:
-            return 7.1
-        elif sqm >= 21.3:
-            return 6.6
-        elif sqm >= 20.8:
-            return 6.3
-        elif sqm >= 20.3:
-            return 6.1
-        elif sqm >= 19.25:
-            return 5.6
-        elif sqm >= 18.5:
-            return 5.1
-        elif sqm >= 18.00:
-            return 4.6
-        else: # this is both classes 8 and 9
-            return 4
-    
-    def _limiting_magnitude(self, use_moon=True):
+    def _limiting_magnitude(self):
         """Returns limiting magnitude by calculating the sky brightness in mags per square arcsecond, and then
         converting to the Bortle scale, and then to limiting magnitude. Takes into account both light pollution
-        and the Moon phase brightness."""
+        and the Moon phase brightness. Also returns the Bortle class from light pollution alone."""
 
-        if use_moon:
-            moon_mag, __, moon_alt = moon_sky_brightness(self.observer)
-            if moon_mag < self._light_pollution and moon_alt > 0: # smaller magnitudes are brighter
-                sky_mag = moon_mag
-            else:
-                sky_mag = self._light_pollution
-        else:
-            sky_mag = self._light_pollution
-
-        limiting_mag = self._sqm_to_bortle_to_limiting_mag(sky_mag)
-        return limiting_mag
+        sun = ephem.Sun(self.observer)
+        moon = ephem.Moon(self.observer)
+        limiting_mag, bortle_class = sky_limiting_magnitude(moon.phase, np.degrees(moon.alt), np.degrees(sun.alt),
+                                                            self._light_pollution, self.observer.elevation,
+                                                            self.use_extinction)
+        return float(limiting_mag), int(bortle_class)
 
     def _ZHR_local(self, return_meteor_info=False):
         """Calculates local visible rates for all meteor sources combined."""
 
-        limiting_mag = self._limiting_magnitude()
+        # the limiting mag is already 0 if it is not astronomical twilight
+        limiting_mag, bortle_class = self._limiting_magnitude()
         # the ZHR_local equation is only defined for limiting magnitudes 6.5 and brighter.
         if limiting_mag > 6.5:
             limiting_mag = 6.5
-        # if not astronomical twilight, the limiting mag should be ignored
-        if not astronomical_twilight(self.observer):
-            limiting_mag = 0 
 
         sun = ephem.Sun()
         sun.compute(self.observer)
@@ -197,7 +158,7 @@ class Meteors():
         total_visible_meteors += visible_sporadics
 
         if return_meteor_info == True:
-            active_showers, bortle_class, moon_illumination = self._meteor_number_info(self._limiting_magnitude(use_moon=False), active_shower_codes)
+            active_showers, bortle_class, moon_illumination = self._meteor_number_info(bortle_class, active_shower_codes)
             return total_visible_meteors, active_showers, bortle_class, moon_illumination
         else:
             return total_visible_meteors
@@ -206,10 +167,15 @@ class Meteors():
         """Returns a graph of the 7-day local visible meteor numbers."""
 
         current_datetime = self.observer.date.datetime()
-        num_meteors_visible = []
         solar_altitude = []
         lunar_phase = []
         lunar_altitude = []
+        # meteor rates before the limiting magnitude correction, one row per time and one column per shower
+        shower_rates = []
+        sporadic_rates = []
+        radiants = list(self.shower_csv["Ephem"])
+        meteor_functions = list(self.shower_csv["Gaussian"])
+        population_index = np.array(self.shower_csv["r"], dtype=float)
         # three days worth of hours, evaluated every fifteen minutes
         hours = np.arange(0, 3*24, 0.25)
         times = []
@@ -223,35 +189,34 @@ class Meteors():
             sun.compute(test_observer)
             solar_altitude.append(np.degrees(sun.alt))
 
-            ____, moon_phase, moon_alt = moon_sky_brightness(self.observer)
-            lunar_phase.append(moon_phase)
-            lunar_altitude.append(np.degrees(moon_alt))
+            moon = ephem.Moon(test_observer)
+            lunar_phase.append(moon.phase)
+            lunar_altitude.append(np.degrees(moon.alt))
 
             # if sun is at the wrong altitude, then no meteors are visible
-            if not astronomical_twilight(test_observer):
-                num_meteors_visible.append(0)
-            else:
-                solar_longitude = np.degrees(sun.ra)
-                total_visible_meteors = 0
-                limiting_mag = self._limiting_magnitude()
-                # the ZHR equation is not defined for limiting mags > 6.5
-                if limiting_mag > 6.5:
-                    limiting_mag = 6.5
-                for index, shower in self.shower_csv.iterrows():
-                    meteor_function = shower["Gaussian"]
-                    num_meteors = meteor_function(solar_longitude)
-                    shower["Ephem"].compute(test_observer)
-                    shower_alt = shower["Ephem"].alt  # this is in radians
-                    if shower_alt > 0:
-                        ZHR_local = num_meteors * (np.sin(shower_alt)) / (shower["r"] ** (6.5 - limiting_mag))
-                    else:
-                        ZHR_local = 0
-                    total_visible_meteors += ZHR_local
-                sporadics = self._max_sporadic_meteors()
-                # r = 3 for anthelion (sporadic) meteors, and we assume the radiant is the zenith (since sporadics have no true radiant)
-                visible_sporadics = sporadics * (np.sin(90)) / (3 ** (6.5 - limiting_mag))
-                total_visible_meteors += visible_sporadics
-                num_meteors_visible.append(total_visible_meteors)
+            if solar_altitude[-1] > ASTRONOMICAL_TWILIGHT_ALT:
+                shower_rates.append(np.zeros(len(radiants)))
+                sporadic_rates.append(0)
+                continue
+
+            solar_longitude = np.degrees(sun.ra)
+            rates = np.zeros(len(radiants))
+            for index, radiant in enumerate(radiants):
+                radiant.compute(test_observer)
+                if radiant.alt > 0:  # this is in radians
+                    rates[index] = meteor_functions[index](solar_longitude) * np.sin(radiant.alt)
+            shower_rates.append(rates)
+            sporadic_rates.append(self._max_sporadic_meteors())
+
+        # the limiting magnitudes for the whole time series are found in one call
+        limiting_mag, __ = sky_limiting_magnitude(lunar_phase, lunar_altitude, solar_altitude, self._light_pollution,
+                                                  self.observer.elevation, self.use_extinction)
+        # the ZHR equation is not defined for limiting mags > 6.5
+        limiting_mag = np.minimum(limiting_mag, 6.5)
+        # shower_rates is (times, showers), so each time's limiting mag is broadcast across the showers
+        num_meteors_visible = np.sum(np.array(shower_rates) / (population_index ** (6.5 - limiting_mag[:, None])), axis=1)
+        # r = 3 for anthelion (sporadic) meteors, and we assume the radiant is the zenith (since sporadics have no true radiant)
+        num_meteors_visible += np.array(sporadic_rates) * (np.sin(90)) / (3 ** (6.5 - limiting_mag))
 
         local_times = np.array(times) + self.UTC_offset
 
@@ -4,6 +4,26 @@ import requests
 from datetime import datetime
 from CustomErrors import APIError
 
+# X-values must be in increasing order, otherwise np.interp returns meaningless values
+# Moon illumination fraction and the corresponding apparent magnitude
+# Data is from Table 1 of M. Minnaert (1961), as shown in:
+# https://github.com/pchev/skychart/blob/98b7ac40b660beb6acd33d3d183e401e9fe76388/skychart/cu_planet.pas#L1315
+MOON_ILLUMINATION = np.array([0.03, 0.07, 0.12, 0.18, 0.25, 0.33, 0.41, 0.5, 0.59, 0.67, 0.75, 0.82,
+                              0.88, 0.93, 0.97, 0.99, 1.0])
+MOON_APPARENT_MAGS = np.array([-3.4, -6.7, -7.6, -8.2, -8.7, -9.2, -9.6, -10.0, -10.4, -10.8, -11.0,
+                               -11.2, -11.5, -11.8, -12.1, -12.4, -12.7])
+
+# Lower SQM edge (in mags per square arcsec) of each Bortle band, brightest sky first, and the limiting
+# magnitude of each band. The first limiting magnitude is for skies brighter than 18.00 (classes 8 and 9).
+SQM_BORTLE_EDGES = np.array([18.00, 18.5, 19.25, 20.3, 20.8, 21.3, 21.6, 21.75])
+BORTLE_LIMITING_MAGS = np.array([4, 4.6, 5.1, 5.6, 6.1, 6.3, 6.6, 7.1, 7.6])
+
+# Lower limiting magnitude edge of Bortle classes 7 through 1. Anything below 4.6 is class 8 or 9.
+LIMITING_MAG_BORTLE_EDGES = np.array([4.6, 5.1, 5.6, 6.3, 6.6, 7.1, 7.6])
+
+# Sun altitude (in degrees) at the end of astronomical twilight
+ASTRONOMICAL_TWILIGHT_ALT = -18
+
 def mcd_to_SQM(mcd):
     """Converts brightness from mcd/m2 into mag/arcsec2."""
 
@@ -35,82 +55,96 @@ def astronomical_twilight(observer):
     """Checks if the observer has selected a time that is after astronomical twilight."""
 
     sun = ephem.Sun(observer)
-    if np.degrees(sun.alt) <= -18:
+    if np.degrees(sun.alt) <= ASTRONOMICAL_TWILIGHT_ALT:
         return True
     else:
         return False
 
-def moon_sky_brightness(observer):
-    """Calculates the additional sky brightness from the moon phase."""
+def moon_phase_to_sky_brightness(moon_phase):
+    """Converts moon phase (0-100, as returned by ephem) into the moon's skyglow in mags per square arcsec.
+    Accepts scalars or arrays."""
 
-    # X-values must be in increasing order, otherwise np.interp returns meaningless values
-    # This is [[illumination percentage], [apparent magnitude]]
-    # Data is from Table 1 of M. Minnaert (1961), as shown in:
-    # https://github.com/pchev/skychart/blob/98b7ac40b660beb6acd33d3d183e401e9fe76388/skychart/cu_planet.pas#L1315
-    moon_illumination_mags = np.array([[0.03, 0.07, 0.12, 0.18, 0.25, 0.33, 0.41, 0.5, 0.59, 0.67, 0.75, 0.82, 
-                                        0.88, 0.93, 0.97, 0.99, 1.0],
-                                        [-3.4, -6.7, -7.6, -8.2, -8.7, -9.2, -9.6, -10.0, -10.4, -10.8, -11.0, 
-                                        -11.2, -11.5, -11.8, -12.1, -12.4, -12.7]])
-    
-    moon = ephem.Moon(observer)
     # ephem returns this as a 0-100 number, so I am converting this to a percentage
-    moon_illumination = moon.phase * 0.01
-    moon_apparent_mag = np.interp(moon_illumination, moon_illumination_mags[0], moon_illumination_mags[1])
+    moon_illumination = np.asarray(moon_phase) * 0.01
+    moon_apparent_mag = np.interp(moon_illumination, MOON_ILLUMINATION, MOON_APPARENT_MAGS)
 
     # Calculating its contribution to skyglow, as specified at:
     # https://www.cloudynights.com/topic/623469-sqm-readings-during-full-moon/
-    sky_brightness = moon_apparent_mag + 30.2
+    return moon_apparent_mag + 30.2
+
+def moon_sky_brightness(observer):
+    """Calculates the additional sky brightness from the moon phase."""
+
+    moon = ephem.Moon(observer)
+    sky_brightness = moon_phase_to_sky_brightness(moon.phase)
     return sky_brightness, moon.phase, moon.alt
 
-#  Function for use in future code updates
-def _object_extinction(observer, object):
-    """Calculates the extinction of an object's light due to the thickness of the atmosphere."""
-
-    object_is_up = object.alt > 0
-    if object_is_up:
-        airmass = 1 / (np.cos(object.alt) + 0.025 * np.exp(-11 * np.cos(object.alt)))
-
-        # total extinction = Rayleigh extinction + aerosol extinction + ozone extinction
-        # apparent mag = actual visual magnitude + (total extinction * airmass)
-        # Rayleigh extinction
-        A_ray = 0.1451 * np.exp((-1 * observer.alt) / 7.996)
-        # Aerosol extinction
-        A_aer = 0.120 * np.exp((-1 * observer.alt) / 1.5)
-        # Ozone extinction
-        A_oz = 0.016
-
-        A_prime = A_ray + A_aer + A_oz
-        extinction = airmass * A_prime
-        return extinction
-    else:
-        return 0
-    
-"""def sqm_to_bortle_to_limiting_mag(sqm):
-    Converts mags per square arcsecond into Bortle class, and returns the corresponding limiting magnitude.
-
-    if sqm >= 21.75:
-        return 7.6
-    elif sqm >= 21.6:
-        return 7.1
-    elif sqm >= 21.3:
-        return 6.6
-    elif sqm >= 20.8:
-        return 6.3
-    elif sqm >= 20.3:
-        return 6.1
-    elif sqm >= 19.25:
-        return 5.6
-    elif sqm >= 18.5:
-        return 5.1
-    elif sqm >= 18.00:
-        return 4.6
-    else: # this is both classes 8 and 9
-        return 4
-    
-def limiting_magnitude(observer):
-    Returns limiting magnitude by calculating the sky brightness in mags per square arcsecond, and then
-    converting to the Bortle scale, and then to limiting magnitude.
-
-    light_pollution_mag = light_pollution(observer)
-    limiting_mag = sqm_to_bortle_to_limiting_mag(light_pollution_mag)
-    return limiting_mag"""
\ No newline at end of file
+def object_extinction(object_alt, elevation=0):
+    """Calculates the extinction (in magnitudes) of an object's light due to the thickness of the atmosphere.
+    Takes the object's altitude in degrees and the observer's elevation in meters, as scalars or arrays.
+    Objects below the horizon have no extinction."""
+
+    object_alt = np.radians(object_alt)
+    # clipping keeps the airmass finite below the horizon, where it is discarded anyway
+    sin_alt = np.sin(np.clip(object_alt, 0, None))
+    # scale heights below are in km
+    elevation = np.asarray(elevation) / 1000
+    # the airmass formula uses the cosine of the zenith angle, which is the sine of the altitude
+    airmass = 1 / (sin_alt + 0.025 * np.exp(-11 * sin_alt))
+
+    # total extinction = Rayleigh extinction + aerosol extinction + ozone extinction
+    # apparent mag = actual visual magnitude + (total extinction * airmass)
+    # Rayleigh extinction
+    A_ray = 0.1451 * np.exp((-1 * elevation) / 7.996)
+    # Aerosol extinction
+    A_aer = 0.120 * np.exp((-1 * elevation) / 1.5)
+    # Ozone extinction
+    A_oz = 0.016
+
+    A_prime = A_ray + A_aer + A_oz
+    return np.where(object_alt > 0, airmass * A_prime, 0.0)
+
+def sqm_to_limiting_mag(sqm):
+    """Converts mags per square arcsecond into Bortle class, and returns the corresponding limiting magnitude.
+    Accepts scalars or arrays. Missing (NaN) values are treated as the brightest skies."""
+
+    band = np.digitize(sqm, SQM_BORTLE_EDGES)
+    # np.digitize puts NaN in the darkest band
+    band = np.where(np.isnan(sqm), 0, band)
+    return BORTLE_LIMITING_MAGS[band]
+
+def limiting_mag_to_bortle(limiting_mag):
+    """Converts limiting magnitude into Bortle class. Classes 8 and 9 are both returned as 8.
+    Accepts scalars or arrays. Missing (NaN) values are treated as the brightest skies."""
+
+    band = np.digitize(limiting_mag, LIMITING_MAG_BORTLE_EDGES)
+    # np.digitize puts NaN in the darkest band
+    band = np.where(np.isnan(limiting_mag), 0, band)
+    return 8 - band
+
+def sky_limiting_magnitude(moon_phase, moon_alt, sun_alt, light_pollution_sqm, elevation=0, use_extinction=False):
+    """Returns the limiting magnitude and Bortle class of the sky for whole time series or batches of sites.
+    Takes the moon phase (0-100), moon and sun altitudes (in degrees), light pollution (in mags per square
+    arcsec), and observer elevation (in meters), as scalars or broadcastable arrays. The sky brightness is
+    whichever of the moon's skyglow (while it is up) and the light pollution is brighter. If use_extinction
+    is True, the moon's light is dimmed by the atmosphere before comparing. The limiting magnitude is 0 before
+    astronomical twilight ends. The Bortle class only depends on the light pollution, so it doesn't change
+    with the moon or the time of day."""
+
+    moon_alt = np.asarray(moon_alt)
+    light_pollution_sqm = np.asarray(light_pollution_sqm)
+
+    moon_mag = moon_phase_to_sky_brightness(moon_phase)
+    if use_extinction:
+        moon_mag = moon_mag + object_extinction(moon_alt, elevation)
+    # smaller magnitudes are brighter
+    moon_is_brighter = (moon_mag < light_pollution_sqm) & (moon_alt > 0)
+    sky_mag = np.where(moon_is_brighter, moon_mag, light_pollution_sqm)
+
+    limiting_mag = sqm_to_limiting_mag(sky_mag)
+    # if not astronomical twilight, the limiting mag should be ignored
+    limiting_mag = np.where(np.asarray(sun_alt) <= ASTRONOMICAL_TWILIGHT_ALT, limiting_mag, 0)
+
+    bortle_class = limiting_mag_to_bortle(sqm_to_limiting_mag(light_pollution_sqm))
+    bortle_class = np.broadcast_to(bortle_class, limiting_mag.shape).copy()
+    return limiting_mag, bortle_class